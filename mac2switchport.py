@@ -48,6 +48,7 @@
 ###     Python Libraries
 ###         requests
 ###         certifi
+###         orjson                  Optional, used for faster JSON encoding/decoding when installed
 ###
 ### Usage
 ###     Specify MAC address via argument
@@ -58,7 +59,7 @@
 ###         echo aa:bb:cc:dd:ee:ff | ./mac2switchport.py
 ###         {"mac": "aa:bb:cc:dd:ee:ff", "vendor": "OUI-Vendor-Name", "switch": "switch-name", "port": "Gi0/23", "vlan": "vlan-name", "ipaddress": "10.1.2.3"}
 ###
-###     Specify MAC address via STDIN
+###     Specify Multiple MAC addresses via STDIN, one per line (returns a JSON list)
 ###         echo "                                                                                                                         ─╯
 ###             94:c6:91:09:18:20
 ###             94:c6:91:09:18:20" | python3 mac2switchport.py
@@ -82,12 +83,29 @@ import os
 import sys
 import json
 import re
+import ssl
+import csv
+import functools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-import argparse
+
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode()
+
+    _loads = json.loads
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
 if not os.environ.get("AKIPS_URL"):
     raise Exception("AKIPS_URL environment variable is not set!")
@@ -104,30 +122,196 @@ if not os.environ.get("AKIPS_CERT"):
 else:
     AKIPS_CERT = os.environ.get("AKIPS_CERT")
 
+# Switch Port Mapper endpoint and read-only credentials, built once; params= handles URL-encoding of the password
+_API_URL = AKIPS_URL + "/api-spm"
+_BASE_PARAMS = (("username", "api-ro"), ("password", AKIPS_API_RO_PASSWORD))
+
+# Delimiters and whitespace stripped from MAC addresses before they are put in canonical form
+_MAC_DELIMS = re.compile(r'[.:\-\s]')
+
+# Error line the AKIPS API returns for a MAC address it has never seen
+_UNRESOLVED = re.compile(r"Can't resolve mac address (\S+)")
+
+# Upper bound on concurrent lookups, sized to the connection pool so threads never wait on a socket or overload AKIPS
+MAX_WORKERS = 32
+
+# Most MACs sent in one batch request, keeping the query string well under common server URL limits (~8KB)
+BATCH_SIZE = 200
+
+# TLS settings for AKIPS, built once so the CA bundle is parsed a single time rather than on every new connection
+if AKIPS_CERT:
+    SSL_CONTEXT = ssl.create_default_context(cafile=AKIPS_CERT)
+else:
+    SSL_CONTEXT = ssl.create_default_context()
+    SSL_CONTEXT.check_hostname = False
+    SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+
+class SSLContextAdapter(HTTPAdapter):
+    ''' HTTPAdapter whose connections all share a prebuilt SSLContext '''
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        #The CA bundle is already loaded into ssl_context; leaving the path set makes urllib3 load it again for each connection
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+
+
+# One pooled session for every lookup so the TCP/TLS connection to AKIPS is kept alive between requests
+SESSION = requests.Session()
+SESSION.mount(AKIPS_URL, SSLContextAdapter(SSL_CONTEXT, pool_connections=1, pool_maxsize=MAX_WORKERS))
+
+# Columns of the AKIPS Switch Port Mapper response, also used as the JSON keys
+_FIELDS = ("mac", "vendor", "switch", "port", "vlan", "ipaddress")
+
+# One row of the AKIPS Switch Port Mapper response
+SwitchPort = namedtuple('SwitchPort', _FIELDS)
+
+@functools.lru_cache(maxsize=8192)
 def format_mac(mac: str) -> str:
-    mac = re.sub('[.:-]', '', mac).lower()  # remove delimiters and convert to lower case
-    mac = ''.join(mac.split())  # remove whitespaces
-    assert len(mac) == 12  # length should be now exactly 12 (eg. aabbccddeeff)
-    assert mac.isalnum()  # should only contain letters and numbers
+    mac = bytes.fromhex(_MAC_DELIMS.sub('', mac))  # remove delimiters and whitespace, raises ValueError on non-hex digits
+    assert len(mac) == 6  # should be exactly 6 octets (eg. aabbccddeeff)
     # convert mac in canonical form (eg. aa:bb:cc:dd:ee:ff)
-    mac = ":".join(["%s" % (mac[i:i+2]) for i in range(0, 12, 2)])
-    return mac
+    return mac.hex(':')
+
+
+def _iter_lines(r):
+    ''' Yields the decoded lines of a streamed API response as they arrive '''
+    if r.encoding is None:
+        r.encoding = 'utf-8'
+    return r.iter_lines(chunk_size=65536, decode_unicode=True)
+
+
+def _parse_rows(lines, unresolved=None):
+    ''' Parses the CSV lines returned by the AKIPS API into a list of SwitchPorts, skipping error lines '''
+    retval = []
+    for row in csv.reader(lines):
+        if len(row) == 6:
+            if not retval:
+                #AKIPS returns canonical MACs, so check the first row once instead of reformatting every row
+                assert len(row[0]) == 17, "MAC Address must be 17 characters"
+            retval.append(SwitchPort._make(row))
+        elif unresolved is not None and len(row) == 1:
+            unresolved.update(_UNRESOLVED.findall(row[0]))
+    return retval
+
+
+@functools.lru_cache(maxsize=4096)
+def _fetch(mac, raw=False):
+    ''' Queries the API for a canonical MAC.  Results are cached per process (clear with _fetch.cache_clear()) and must not be mutated '''
+    with SESSION.get(_API_URL, params=_BASE_PARAMS + (("mac", mac),), verify=AKIPS_CERT, stream=True) as r:
+        logger.debug(r)
+        if raw:
+            return r.text
+        else:
+            retval = _parse_rows(_iter_lines(r))
+            return retval[0] if len(retval) == 1 else retval
 
 
 def mac2switchport(mac, raw=False):
     logger.debug("mac2switchport entry")
-    #assert len(format_mac(mac)) == 17, "MAC Address must be 17 characters"
-    r = requests.get(AKIPS_URL + "/api-spm?username=api-ro;password=" + AKIPS_API_RO_PASSWORD + ";mac=" + format_mac(mac), verify=AKIPS_CERT)
-    logger.debug(r)
-    if raw:
-        return r.text
+    #Canonicalize first so every spelling of the same MAC shares one cache entry
+    return _fetch(format_mac(mac), raw)
+
+
+def _fetch_batch(macs, found, accounted):
+    ''' Queries the API for a group of canonical MACs in one request, filling in found rows and the MACs the reply accounted for '''
+    with SESSION.get(_API_URL, params=_BASE_PARAMS + tuple(("mac", mac) for mac in macs), verify=AKIPS_CERT, stream=True) as r:
+        logger.debug(r)
+        if r.ok:
+            for row in _parse_rows(_iter_lines(r), accounted):
+                if row.mac in found:
+                    found[row.mac].append(row)
+                    accounted.add(row.mac)
+
+
+def mac2switchport_batch(macs):
+    ''' Looks up several MACs with as few API requests as possible, made up front, and returns an iterator of results in input order '''
+    logger.debug("mac2switchport_batch entry")
+    macs = [format_mac(mac) for mac in macs]
+    unique = list(dict.fromkeys(macs))
+    if not unique:
+        return iter([])
+    found = {mac: [] for mac in unique}
+    accounted = set()
+    for i in range(0, len(unique), BATCH_SIZE):
+        _fetch_batch(unique[i:i + BATCH_SIZE], found, accounted)
+
+    #Anything the server neither answered nor rejected was dropped (eg. the API only honours one mac= per request), so look those up individually
+    missing = [mac for mac in unique if mac not in accounted]
+    if missing:
+        logger.debug("Falling back to single MAC lookups for %s", missing)
+        #Resolved before returning so a failed lookup raises before _emit has written anything
+        for mac, result in zip(missing, _iter_many(missing, False)):
+            found[mac] = result if type(result) is list else [result]
+
+    return (found[mac][0] if len(found[mac]) == 1 else found[mac] for mac in macs)
+
+
+def _asdicts(result):
+    ''' Converts SwitchPorts (and lists of them) to dicts for JSON output '''
+    if type(result) is SwitchPort:
+        return dict(zip(_FIELDS, result))
+    elif type(result) is list:
+        return [_asdicts(i) for i in result]
+    return result
+
+
+def _iter_many(macs, raw=False):
+    ''' Yields thread pool lookup results in input order as each one completes '''
+    if not macs:
+        return
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(macs))) as ex:
+        yield from ex.map(lambda mac: mac2switchport(mac, raw), macs)
+
+
+def _enable_debug():
+    ''' Sends this script's debug logging to stderr '''
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    logger.setLevel(logging.DEBUG)
+
+
+def _write(result):
+    ''' Writes a result to stdout as JSON in a single write '''
+    try:
+        sys.stdout.buffer.write(_dumps(_asdicts(result)) + b"\n")
+        sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        pass
+
+
+def _emit(results):
+    ''' Writes an iterable of results to stdout as a JSON list, one element at a time '''
+    try:
+        out = sys.stdout.buffer
+        sep = b"[\n  "
+        for result in results:
+            #Indent each element's lines so the output matches dumping the whole list at once
+            out.write(sep + _dumps(_asdicts(result)).replace(b"\n", b"\n  "))
+            sep = b",\n  "
+        out.write(b"[]\n" if sep == b"[\n  " else b"\n]\n")
+        out.flush()
+    except BrokenPipeError:
+        pass
+
+
+def _answer(json_in):
+    ''' Looks up and writes the result for one JSON document read from STDIN '''
+    if type(json_in) is dict and type(json_in['mac']) is list:
+        _emit(mac2switchport_batch(json_in['mac']))
+    elif type(json_in) is dict:
+        _write(mac2switchport(json_in['mac'], False))
+    elif type(json_in) is list:
+        _emit(mac2switchport_batch([ele['mac'] if type(ele) is dict else ele for ele in json_in]))
     else:
-        retval = []
-        for j in r.text.split('\n'):
-            i = j.split(',')
-            if len(i) == 6:
-                retval.append({"mac": format_mac(i[0]), "vendor": i[1], "switch": i[2], "port": i[3], "vlan": i[4], "ipaddress": i[5]})
-        return retval[0] if len(retval) == 1 else retval
+        _write(mac2switchport(json_in, False))
 
 
 def main():
@@ -135,42 +319,29 @@ def main():
     if len(sys.argv) == 1:
         stdin = sys.stdin.read()
         try:
-            #Was JSON passed in?
-            for line in stdin.split('\n'):
-                if len(line) == 0:
-                    continue
-                json_in = json.loads(line)
-                logger.debug(json_in)
-                if type(json_in) is dict:
-                    retval = []
-                    for mac in json_in['mac']:
-                        retval.append(mac2switchport(mac, False))
-                    print(json.dumps(retval, indent=2))
-                    sys.stdout.flush()
-                elif type(json_in) is list:
-                    retval = []
-                    for ele in json_in:
-                        retval.append(mac2switchport(ele['mac'], False))
-                    print(json.dumps(retval, indent=2))
-                    sys.stdout.flush()
+            #Was JSON passed in?  One parse of the whole input, so a document may span several lines
+            docs = [_loads(stdin)]
         except json.decoder.JSONDecodeError:
-            logger.debug("STDIN is not JSON")
-            #Something was passed in, but it's not JSON... Let's assume it's a MAC address (or a \n separated list of MAC addresses)
             try:
-                for line in stdin.split('\n'):
-                    if len(line) == 0:
-                        continue
-                    #ToDo: Make this return a json list [] by saving results to retval and then outputting that.
-                    print(json.dumps(mac2switchport(line, False), indent=2))
-                    sys.stdout.flush()
-            except BrokenPipeError:
-                pass
-            except:
-                raise
-        except:
-            raise
+                #Or one JSON document per line
+                docs = [_loads(line) for line in stdin.splitlines() if line.strip()]
+            except json.decoder.JSONDecodeError:
+                docs = []
+        logger.debug(docs)
+        if docs and all(type(doc) in (dict, list, str) for doc in docs):
+            for doc in docs:
+                _answer(doc)
+        else:
+            logger.debug("STDIN is not JSON")
+            #Something was passed in, but it's not JSON (or is a bare number like 001122334455)... Let's assume it's a MAC address (or a \n separated list of MAC addresses)
+            macs = [line for line in stdin.splitlines() if line.strip()]
+            if len(macs) == 1:
+                _write(mac2switchport(macs[0], False))
+            elif macs:
+                _emit(mac2switchport_batch(macs))
 
     else:
+        import argparse  # only needed for CLI arguments, so STDIN runs skip the import
         parser = argparse.ArgumentParser(description='Fetch switchports where AKIPS has seen this MAC Address')
         parser.add_argument("--mac", help="The MAC Address you'd like to query.  Supports: 11:22:33:44:55:66:77, 1122.3344.5566, 11-22-33-44-55-66-77", type=str, required=True)
         parser.add_argument("--raw", help="Output raw results from API", action="store_true")
@@ -178,11 +349,10 @@ def main():
         args = parser.parse_args()
 
         if (args.debug):
-            logger.setLevel(logging.DEBUG)
+            _enable_debug()
         logger.debug("Loaded")
 
-        print(json.dumps(mac2switchport(args.mac, args.raw), indent=2))
-        sys.stdout.flush()
+        _write(mac2switchport(args.mac, args.raw))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+import io
+import os
+import sys
+import json
+
+import pytest
+import requests
+
+os.environ.setdefault("AKIPS_URL", "https://akips.example.edu")
+os.environ.setdefault("AKIPS_API_RO_PASSWORD", "secret")
+
+import mac2switchport as m
+
+ROWS = {
+    "aa:bb:cc:dd:ee:ff": ["aa:bb:cc:dd:ee:ff,Société Vendor,sw1,Gi0/1,vlan10,10.0.0.1"],
+    "00:11:22:33:44:55": ["00:11:22:33:44:55,\"Vendor, Inc.\",sw1,Gi0/2,vlan10,10.0.0.2",
+                          "00:11:22:33:44:55,\"Vendor, Inc.\",sw2,Gi0/9,vlan20,10.0.0.2"],
+}
+
+
+class FakeResponse:
+    ''' Minimal stand-in for a streamed requests.Response '''
+    def __init__(self, text, ok=True):
+        self.text = text
+        self.ok = ok
+        self.encoding = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_lines(self, chunk_size=512, decode_unicode=False):
+        return iter(self.text.splitlines())
+
+
+class FakeAKIPS:
+    ''' Answers api-spm queries from ROWS, optionally honouring only the last mac= like a single-MAC server '''
+    def __init__(self, single=False, fail=()):
+        self.single = single
+        self.fail = set(fail)
+        self.calls = []
+
+    def get(self, url, params=(), verify=None, stream=False):
+        macs = [value for key, value in params if key == "mac"]
+        self.calls.append(macs)
+        if self.single:
+            macs = macs[-1:]
+        if self.fail.intersection(macs):
+            raise requests.exceptions.ConnectionError("connection reset")
+        lines = []
+        for mac in macs:
+            lines += ROWS.get(mac, ["Can't resolve mac address %s" % mac])
+        return FakeResponse("\n".join(lines) + "\n")
+
+
+@pytest.fixture
+def akips(monkeypatch):
+    def install(**kwargs):
+        fake = FakeAKIPS(**kwargs)
+        monkeypatch.setattr(m.SESSION, "get", fake.get)
+        return fake
+    m._fetch.cache_clear()
+    yield install
+    m._fetch.cache_clear()
+
+
+def run_main(monkeypatch, capsysbinary, stdin):
+    monkeypatch.setattr(sys, "argv", ["mac2switchport.py"])
+    monkeypatch.setattr(sys, "stdin", io.StringIO(stdin))
+    m.main()
+    return capsysbinary.readouterr().out
+
+
+@pytest.mark.parametrize("mac", ["aa:bb:cc:dd:ee:ff", "AA-BB-CC-DD-EE-FF", "aabb.ccdd.eeff", " AABBCCDDEEFF\n"])
+def test_format_mac_canonicalizes(mac):
+    assert m.format_mac(mac) == "aa:bb:cc:dd:ee:ff"
+
+
+@pytest.mark.parametrize("mac", ["zz:zz:zz:zz:zz:zz", "ab:cd:ef:gh:ij:kl", "aabbccddeegg"])
+def test_format_mac_rejects_non_hex(mac):
+    with pytest.raises(ValueError):
+        m.format_mac(mac)
+
+
+@pytest.mark.parametrize("mac", ["aa:bb:cc:dd:ee", "aa:bb:cc:dd:ee:ff:00", ""])
+def test_format_mac_rejects_wrong_length(mac):
+    with pytest.raises(AssertionError):
+        m.format_mac(mac)
+
+
+@pytest.mark.parametrize("single", [False, True])
+def test_batch_keeps_input_order(akips, single):
+    fake = akips(single=single)
+    results = list(m.mac2switchport_batch(["0011.2233.4455", "ff:ff:ff:ff:ff:ff", "AA:BB:CC:DD:EE:FF", "aa:bb:cc:dd:ee:ff"]))
+    assert [type(result) for result in results] == [list, list, m.SwitchPort, m.SwitchPort]
+    assert [row.switch for row in results[0]] == ["sw1", "sw2"]
+    assert results[0][0].vendor == "Vendor, Inc."
+    assert results[1] == []
+    assert results[2] == results[3]
+    assert results[2].mac == "aa:bb:cc:dd:ee:ff"
+    #Duplicates are sent once; a single-MAC server needs a fallback lookup for the MACs it dropped
+    assert fake.calls[0] == ["00:11:22:33:44:55", "ff:ff:ff:ff:ff:ff", "aa:bb:cc:dd:ee:ff"]
+    assert len(fake.calls) == (3 if single else 1)
+
+
+def test_empty_batch_makes_no_request(akips):
+    fake = akips()
+    assert list(m.mac2switchport_batch([])) == []
+    assert fake.calls == []
+
+
+def test_batch_is_split_into_bounded_requests(akips, monkeypatch):
+    fake = akips()
+    monkeypatch.setattr(m, "BATCH_SIZE", 2)
+    macs = ["02:00:00:00:00:%02x" % i for i in range(5)]
+    assert list(m.mac2switchport_batch(macs)) == [[]] * 5
+    assert fake.calls == [macs[0:2], macs[2:4], macs[4:5]]
+
+
+@pytest.mark.parametrize("results", [
+    [],
+    [m.SwitchPort("aa:bb:cc:dd:ee:ff", "Société Vendor", "sw1", "Gi0/1", "vlan10", "10.0.0.1"), [], "text"],
+    [[m.SwitchPort("00:11:22:33:44:55", "Vendor", "sw1", "Gi0/2", "vlan10", "10.0.0.2")] * 2],
+])
+def test_emit_matches_json_dumps(capsysbinary, results):
+    m._emit(iter(results))
+    expected = json.dumps(m._asdicts(results), indent=2, ensure_ascii=False) + "\n"
+    assert capsysbinary.readouterr().out == expected.encode()
+
+
+def test_main_answers_one_json_document_per_line(akips, monkeypatch, capsysbinary):
+    akips()
+    out = run_main(monkeypatch, capsysbinary, '{"mac": ["aa:bb:cc:dd:ee:ff"]}\n{"mac": ["ff:ff:ff:ff:ff:ff"]}\n')
+    first, second = out.decode().split("\n[", 1)
+    assert json.loads(first)[0]["switch"] == "sw1"
+    assert json.loads("[" + second) == [[]]
+
+
+def test_main_writes_nothing_when_a_fallback_lookup_fails(akips, monkeypatch, capsysbinary):
+    #The batch request only answers ff:..., so aa:... and 00:... are looked up individually and the second one fails
+    fake = akips(single=True, fail=["00:11:22:33:44:55"])
+    with pytest.raises(requests.exceptions.ConnectionError):
+        run_main(monkeypatch, capsysbinary, '{"mac": ["aa:bb:cc:dd:ee:ff", "00:11:22:33:44:55", "ff:ff:ff:ff:ff:ff"]}')
+    assert ["00:11:22:33:44:55"] in fake.calls
+    assert capsysbinary.readouterr().out == b""